@@ -6,6 +6,24 @@ import pandas as pd
 import numpy as np
 from datetime import datetime
 import plotly.io as pio
+from functools import lru_cache
+import zlib
+import warnings
+
+from kernels import run_paths as run_paths_python, run_paths_numpy, check_parity
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+try:
+    # Precompiled by build_kernels.py; runs without numba installed
+    from sim_kernels import run_paths as run_paths_aot
+    AOT_AVAILABLE = True
+except ImportError:
+    AOT_AVAILABLE = False
 
 # Initialize the Dash app
 app = dash.Dash(__name__)
@@ -24,76 +42,111 @@ def get_default_params():
         'num_simulations': 100
     }
 
-# Function to calculate trailing returns
+# Function to calculate trailing returns along the last axis (one row per simulation)
 def calculate_trailing_return(returns, window=24):
-    trailing_returns = []
-    for i in range(len(returns)):
-        if i < window:
-            trailing_returns.append(np.nan)
-        else:
-            # Calculate the total return over the window period
-            window_returns = returns[i-window:i]
-            # Calculate cumulative return using compound interest formula
-            cumulative_return = np.prod(1 + window_returns) - 1
-            # Annualize the return
-            annualized_return = (1 + cumulative_return)**(12/window) - 1
-            trailing_returns.append(annualized_return)
+    returns = np.asarray(returns, dtype=np.float64)
+    num_months = returns.shape[-1]
+    trailing_returns = np.full(returns.shape, np.nan)
+    if num_months <= window:
+        return trailing_returns
+    
+    # Cumulative log growth, so each window's compound return is a difference of two sums.
+    # Clamp returns of -100% or worse first: log1p would give nan/-inf there and the
+    # cumulative sum would carry it into every later month, not just that month's windows
+    log_growth = np.cumsum(np.log1p(np.maximum(returns, -1 + 1e-12)), axis=-1)
+    log_growth = np.concatenate([np.zeros(returns.shape[:-1] + (1,)), log_growth], axis=-1)
+    # The return at month i covers months i-window .. i-1
+    window_log_growth = log_growth[..., window:num_months] - log_growth[..., :num_months - window]
+    # Annualize the return
+    trailing_returns[..., window:] = np.expm1(window_log_growth * (12/window))
     return trailing_returns
 
-# Function to generate simulation data
-def generate_simulation(params):
+if NUMBA_AVAILABLE:
+    # Compiled kernel: each path runs its own recurrence, paths run in parallel
+    run_paths = njit(parallel=True, fastmath=True, cache=True)(run_paths_python)
+elif AOT_AVAILABLE:
+    run_paths = run_paths_aot
+else:
+    run_paths = run_paths_numpy
+
+# Catch a compiled kernel that has drifted from kernels.py; this also moves
+# JIT compilation to startup instead of the first simulation run. A mismatch
+# falls back to NumPy so the app still starts; build_kernels.py fails hard instead.
+if run_paths is not run_paths_numpy:
+    try:
+        check_parity(run_paths, 'numba' if NUMBA_AVAILABLE else 'sim_kernels')
+    except RuntimeError as e:
+        warnings.warn(f"{e}; falling back to the NumPy simulation kernel")
+        run_paths = run_paths_numpy
+
+# Function to build the monthly plot dates, shared by every run of the same length
+@lru_cache(maxsize=8)
+def get_date_range(num_months):
     starting_date = pd.to_datetime('2025-01-01')
+    return pd.date_range(start=starting_date, periods=num_months, freq='ME')
+
+# Function to generate simulation data
+def generate_simulation(params, seed=None):
+    rng = np.random.default_rng(seed)
     # Calculate months until retirement
     num_months = (params['retirement_age'] - params['starting_age']) * 12
-    date_range = pd.date_range(start=starting_date, periods=num_months, freq='ME')
     
-    # Initialize DataFrame
-    df = pd.DataFrame(index=date_range)
+    # Age and monthly cash flows, shared by all simulations
+    age = params['starting_age'] + np.arange(num_months, dtype=np.float64) / 12
     
-    # Add columns
-    df['Age'] = params['starting_age'] + (df.index - df.index[0]).days / 365.25
+    # Calculate monthly income and expenses with inflation compounded monthly
+    monthly_inflation = (1 + params['inflation_rate'])**(1/12) - 1
+    inflation_factor = np.cumprod(np.full(num_months, 1 + monthly_inflation)) / (1 + monthly_inflation)
+    monthly_income = params['monthly_income'] * inflation_factor
+    monthly_expenses = params['monthly_expenses'] * inflation_factor
+    monthly_investment = monthly_income - monthly_expenses
     
-    # Calculate monthly income and expenses with inflation
-    df['Monthly_Income'] = params['monthly_income'] * (1 + params['inflation_rate'])**(df['Age'] - params['starting_age'])
-    df['Monthly_Expenses'] = params['monthly_expenses'] * (1 + params['inflation_rate'])**(df['Age'] - params['starting_age'])
-    df['Monthly_Investment'] = df['Monthly_Income'] - df['Monthly_Expenses']
-    
-    # Generate returns
+    # Generate returns and portfolio values for all simulations at once
+    num_simulations = params['num_simulations']
     monthly_volatility = params['annual_volatility'] / np.sqrt(12)
     monthly_expected_return = (1 + params['annual_return_rate'])**(1/12) - 1
-    
-    monthly_returns = np.random.normal(
-        loc=monthly_expected_return,
-        scale=monthly_volatility,
-        size=len(df)
-    )
-    
-    # Calculate portfolio value
-    df['Portfolio_Value'] = 0.0
-    current_portfolio = params['initial_investment']
     flat_interest_rate = 0.05  # 5% flat interest rate for negative portfolio values
     
-    for i in range(len(df)):
-        if i == 0:
-            # First month calculation
-            portfolio_with_investment = current_portfolio + df.iloc[i, df.columns.get_loc('Monthly_Investment')]
-            if portfolio_with_investment >= 0:
-                df.iloc[i, df.columns.get_loc('Portfolio_Value')] = portfolio_with_investment * (1 + monthly_returns[i])
-            else:
-                df.iloc[i, df.columns.get_loc('Portfolio_Value')] = portfolio_with_investment * (1 + flat_interest_rate/12)
-            current_portfolio = df.iloc[i, df.columns.get_loc('Portfolio_Value')]
-        else:
-            # Subsequent months
-            portfolio_with_investment = current_portfolio + df.iloc[i, df.columns.get_loc('Monthly_Investment')]
-            if portfolio_with_investment >= 0:
-                current_portfolio = portfolio_with_investment * (1 + monthly_returns[i])
-            else:
-                current_portfolio = portfolio_with_investment * (1 + flat_interest_rate/12)
-            df.iloc[i, df.columns.get_loc('Portfolio_Value')] = current_portfolio
+    # Draw every return in one call, then scale and shift in place
+    monthly_returns = rng.standard_normal((num_simulations, num_months), dtype=np.float32)
+    np.multiply(monthly_returns, monthly_volatility, out=monthly_returns)
+    monthly_returns += monthly_expected_return
+    portfolio_values = run_paths(
+        monthly_returns,
+        monthly_investment,
+        float(params['initial_investment']),
+        flat_interest_rate/12
+    )
     
     # Calculate trailing returns
     trailing_returns = calculate_trailing_return(monthly_returns)
-    return df, trailing_returns
+    
+    # Summarize across simulations while the paths are at hand; one call
+    # partitions the values once for all three percentiles
+    percentile_paths = np.percentile(portfolio_values, [10, 50, 90], axis=0)
+    
+    return {
+        'age': age,
+        'monthly_income': monthly_income,
+        'monthly_expenses': monthly_expenses,
+        'monthly_investment': monthly_investment,
+        'portfolio_value': portfolio_values,
+        'trailing_returns': trailing_returns,
+        'percentile_paths': percentile_paths,
+        'max_value': portfolio_values.max()
+    }
+
+# Function to run the simulation once per distinct set of parameters
+@lru_cache(maxsize=8)
+def run_simulation(params_key):
+    # Seed from the parameters so repeated runs with the same inputs match the cache
+    seed = zlib.crc32(repr(params_key).encode())
+    simulation = generate_simulation(dict(params_key), seed=seed)
+    # Cached results are shared between callbacks, so keep them read-only
+    for value in simulation.values():
+        if isinstance(value, np.ndarray):
+            value.setflags(write=False)
+    return simulation
 
 # App layout
 app.layout = html.Div([
@@ -239,37 +292,43 @@ def update_graph(n_clicks, starting_age, retirement_age, monthly_income,
     }
     
     # Generate simulations
-    all_simulations = []
-    all_trailing_returns = []
+    simulation = run_simulation(tuple(sorted(params.items())))
+    portfolio_values = simulation['portfolio_value']
     
-    for _ in range(params['num_simulations']):
-        df, trailing_returns = generate_simulation(params)
-        all_simulations.append(df)
-        all_trailing_returns.append(trailing_returns)
+    # Sample individual paths yearly (always keeping the final month); the
+    # percentile band below keeps full monthly resolution
+    num_months = portfolio_values.shape[1]
+    date_range = get_date_range(num_months)
+    plot_stride = 12
+    plot_idx = np.unique(np.append(np.arange(0, num_months, plot_stride), num_months - 1))
+    plot_dates = date_range[plot_idx]
+    plot_values = portfolio_values[:, plot_idx]
+    plot_trailing_returns = simulation['trailing_returns'][:, plot_idx]
     
-    # Create figure
-    fig = go.Figure()
+    # Format the hover text shared by every simulation once
+    age_texts = [f"Age: {age:.1f}<br>Portfolio Value: $"
+                 for age in simulation['age'][plot_idx]]
+    income_texts = [f"<br>Monthly Income: ${income:,.0f}<br>2-Year Return: "
+                    for income in simulation['monthly_income'][plot_idx]]
     
     # Add traces for each simulation
+    traces = []
     for i in range(params['num_simulations']):
-        fig.add_trace(go.Scatter(
-            x=all_simulations[i].index,
-            y=all_simulations[i]['Portfolio_Value'],
+        traces.append(go.Scattergl(
+            x=plot_dates,
+            y=plot_values[i],
             mode='lines',
             line=dict(
                 color='rgba(128, 128, 128, 0.1)',
                 width=1
             ),
             hoverinfo='text',
-            text=[f"Age: {age:.1f}<br>"
-                  f"Portfolio Value: ${value:,.0f}<br>"
-                  f"Monthly Income: ${income:,.0f}<br>"
-                  f"2-Year Return: {ret:.1%}"
-                  for age, value, income, ret in zip(
-                      all_simulations[i]['Age'],
-                      all_simulations[i]['Portfolio_Value'],
-                      all_simulations[i]['Monthly_Income'],
-                      all_trailing_returns[i]
+            text=[f"{age_text}{value:,.0f}{income_text}{ret:.1%}"
+                  for age_text, value, income_text, ret in zip(
+                      age_texts,
+                      plot_values[i],
+                      income_texts,
+                      plot_trailing_returns[i]
                   )],
             showlegend=False,
             name=f'Simulation {i+1}',
@@ -277,16 +336,43 @@ def update_graph(n_clicks, starting_age, retirement_age, monthly_income,
                 bgcolor='white',
                 font=dict(size=12)
             ),
-            hovertemplate='%{text}<extra></extra>',
-            hoveron='points+fills'
+            hovertemplate='%{text}<extra></extra>'
         ))
     
-    # Calculate statistics
-    final_values = [sim['Portfolio_Value'].iloc[-1] for sim in all_simulations]
-    avg_final = np.mean(final_values)
-    median_final = np.median(final_values)
-    p10_final = np.percentile(final_values, 10)
-    p90_final = np.percentile(final_values, 90)
+    # Add 10th-90th percentile band and median across all simulations
+    p10_path, median_path, p90_path = simulation['percentile_paths']
+    for name, values, fill in [('10th Percentile', p10_path, None),
+                               ('90th Percentile', p90_path, 'tonexty')]:
+        traces.append(go.Scattergl(
+            x=date_range,
+            y=values,
+            mode='lines',
+            line=dict(
+                color='rgba(52, 152, 219, 0.6)',
+                width=1
+            ),
+            fill=fill,
+            fillcolor='rgba(52, 152, 219, 0.15)',
+            showlegend=False,
+            name=name,
+            hovertemplate=f'{name}: $%{{y:,.0f}}<extra></extra>'
+        ))
+    traces.append(go.Scattergl(
+        x=date_range,
+        y=median_path,
+        mode='lines',
+        line=dict(
+            color='#2c3e50',
+            width=2
+        ),
+        showlegend=False,
+        name='Median',
+        hovertemplate='Median: $%{y:,.0f}<extra></extra>'
+    ))
+    
+    # Calculate statistics from the final month of the paths and percentile bands
+    avg_final = np.mean(portfolio_values[:, -1])
+    p10_final, median_final, p90_final = p10_path[-1], median_path[-1], p90_path[-1]
     
     # Calculate expected monthly investment income using 4% safe withdrawal rate
     safe_withdrawal_rate = 0.04
@@ -333,8 +419,8 @@ def update_graph(n_clicks, starting_age, retirement_age, monthly_income,
         ], style={'display': 'flex', 'justifyContent': 'space-between'})
     ])
     
-    # Update layout
-    fig.update_layout(
+    # Create figure with all traces and the layout in one step
+    fig = go.Figure(data=traces, layout=go.Layout(
         title='Retirement Portfolio Growth Simulations',
         xaxis_title='Year',
         yaxis_title='Portfolio Value (USD)',
@@ -347,10 +433,10 @@ def update_graph(n_clicks, starting_age, retirement_age, monthly_income,
             # Add vertical line at retirement age
             dict(
                 type="line",
-                x0=all_simulations[-1].index[-1],
-                x1=all_simulations[-1].index[-1],
+                x0=date_range[-1],
+                x1=date_range[-1],
                 y0=0,
-                y1=max(sim['Portfolio_Value'].max() for sim in all_simulations),
+                y1=simulation['max_value'],
                 line=dict(
                     color="red",
                     width=1,
@@ -359,7 +445,7 @@ def update_graph(n_clicks, starting_age, retirement_age, monthly_income,
                 name="Retirement Age"
             )
         ]
-    )
+    ))
     
     return fig, stats
 
@@ -0,0 +1,17 @@
+from numba.pycc import CC
+
+import kernels
+
+# Ahead-of-time compile the simulation kernel from kernels.py into the
+# sim_kernels extension module, for running the app where numba is not installed.
+# Usage: python build_kernels.py
+cc = CC('sim_kernels')
+
+# Must match what app.py passes in: float32 returns, float64 investment
+cc.export('run_paths', 'f8[:,:](f4[:,:], f8[:], f8, f8)')(kernels.run_paths)
+
+if __name__ == '__main__':
+    cc.compile()
+
+    import sim_kernels
+    kernels.check_parity(sim_kernels.run_paths, 'sim_kernels')
@@ -0,0 +1,61 @@
+import numpy as np
+
+try:
+    from numba import prange
+except ImportError:
+    prange = range
+
+# Portfolio recurrence shared by every backend. app.py compiles run_paths with
+# njit(parallel=True) and build_kernels.py exports it with numba.pycc, so the
+# body has to stay in the subset of Python that numba supports.
+
+# Function to step each simulation path through every month
+def run_paths(returns, investment, initial, flat_m):
+    num_simulations, num_months = returns.shape
+    portfolio_values = np.empty((num_simulations, num_months))
+    flat_growth = 1.0 + flat_m
+    for n in prange(num_simulations):
+        current_portfolio = initial
+        for t in range(num_months):
+            current_portfolio += investment[t]
+            if current_portfolio >= 0:
+                current_portfolio *= 1.0 + returns[n, t]
+            else:
+                current_portfolio *= flat_growth
+            portfolio_values[n, t] = current_portfolio
+    return portfolio_values
+
+# Function to step the portfolio recurrence for every simulation path with NumPy
+def run_paths_numpy(returns, investment, initial, flat_m):
+    num_simulations, num_months = returns.shape
+    portfolio_values = np.empty((num_simulations, num_months))
+    current_portfolio = np.full(num_simulations, float(initial))
+    flat_growth = 1 + flat_m
+    
+    for t in range(num_months):
+        portfolio_with_investment = current_portfolio + investment[t]
+        current_portfolio = portfolio_with_investment * np.where(
+            portfolio_with_investment >= 0,
+            # Grow in float64 like the compiled kernels, even for float32 returns
+            np.add(1.0, returns[:, t], dtype=np.float64),
+            flat_growth
+        )
+        portfolio_values[:, t] = current_portfolio
+    return portfolio_values
+
+# Function to check a compiled kernel against the NumPy stepper on a fixed-seed run
+def check_parity(kernel, name):
+    rng = np.random.default_rng(0)
+    returns = rng.standard_normal((16, 120), dtype=np.float32)
+    returns *= 0.05
+    returns += 0.005
+    # Spending outpaces income part way through, so negative balances are covered
+    investment = np.linspace(1500.0, -3000.0, 120)
+    initial = 10000.0
+    flat_m = 0.05/12
+    
+    expected = run_paths_numpy(returns, investment, initial, flat_m)
+    actual = kernel(returns, investment, initial, flat_m)
+    if not np.allclose(actual, expected, rtol=1e-9, atol=1e-6):
+        raise RuntimeError(f"{name} kernel does not match run_paths_numpy; "
+                           "rebuild it with python build_kernels.py or fix kernels.py")